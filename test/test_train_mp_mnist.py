@@ -1,22 +1,27 @@
 import args_parse
 
+MODEL_OPTS = {
+    '--use_bf16': {
+        'action': 'store_true',
+    },
+}
 FLAGS = args_parse.parse_common_options(
     datadir='/tmp/mnist-data',
     batch_size=128,
     momentum=0.5,
     lr=0.01,
     target_accuracy=98.0,
-    num_epochs=18)
+    num_epochs=18,
+    opts=MODEL_OPTS.items())
 
 import os
 import shutil
 import sys
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torchvision import datasets, transforms
+from torchvision import datasets
 import torch_xla
 import torch_xla.debug.metrics as met
 import torch_xla.distributed.data_parallel as dp
@@ -35,18 +40,39 @@ class MNIST(nn.Module):
     self.bn1 = nn.BatchNorm2d(10)
     self.conv2 = nn.Conv2d(10, 20, kernel_size=5)
     self.bn2 = nn.BatchNorm2d(20)
-    self.fc1 = nn.Linear(320, 50)
+    # Applied on the 20x4x4 pooled features as a full-extent convolution,
+    # this is equivalent to a Linear(320, 50) without a reshape in between.
+    self.fc1 = nn.Conv2d(20, 50, kernel_size=4)
     self.fc2 = nn.Linear(50, 10)
 
   def forward(self, x):
-    x = F.relu(F.max_pool2d(self.conv1(x), 2))
-    x = self.bn1(x)
-    x = F.relu(F.max_pool2d(self.conv2(x), 2))
-    x = self.bn2(x)
-    x = torch.flatten(x, 1)
-    x = F.relu(self.fc1(x))
-    x = self.fc2(x)
-    return F.log_softmax(x, dim=1)
+    x = F.max_pool2d(F.relu(self.bn1(self.conv1(x))), 2)
+    x = F.max_pool2d(F.relu(self.bn2(self.conv2(x))), 2)
+    x = torch.flatten(F.relu(self.fc1(x)), 1)
+    return self.fc2(x)
+
+
+def _get_mnist_dataset(train, batch_multiple=1):
+  # Load and normalize the whole split once, so that the DataLoader only has
+  # to slice a preprocessed tensor instead of running per-sample transforms.
+  mnist = datasets.MNIST(
+      os.path.join(FLAGS.datadir, str(xm.get_ordinal())),
+      train=train,
+      download=True)
+  data = mnist.data.float().div_(255.0).sub_(0.1307).div_(0.3081).unsqueeze_(1)
+  targets = mnist.targets.long()
+  # Pad with dummy samples, marked by a negative target, up to a multiple of
+  # batch_multiple, so that all the batches have the same shape.
+  pad = -len(targets) % batch_multiple
+  if pad:
+    data = torch.cat([data, data.new_zeros((pad,) + data.shape[1:])])
+    targets = torch.cat([targets, targets.new_full((pad,), -1)])
+  return torch.utils.data.TensorDataset(data, targets)
+
+
+def _get_compile_count():
+  data = met.metric_data('CompileTime')
+  return data[0] if data else 0
 
 
 def _train_update(device, x, loss, tracker, writer):
@@ -62,32 +88,23 @@ def _train_update(device, x, loss, tracker, writer):
 def train_mnist():
   torch.manual_seed(1)
 
+  device = xm.xla_device()
   if FLAGS.fake_data:
+    # Create the fake samples directly on the XLA device, so that the device
+    # loaders have nothing to upload at every step.
+    fake_data = (torch.zeros(FLAGS.batch_size, 1, 28, 28, device=device),
+                 torch.zeros(
+                     FLAGS.batch_size, dtype=torch.int64, device=device))
     train_loader = xu.SampleGenerator(
-        data=(torch.zeros(FLAGS.batch_size, 1, 28,
-                          28), torch.zeros(FLAGS.batch_size,
-                                           dtype=torch.int64)),
+        data=fake_data,
         sample_count=60000 // FLAGS.batch_size // xm.xrt_world_size())
     test_loader = xu.SampleGenerator(
-        data=(torch.zeros(FLAGS.batch_size, 1, 28,
-                          28), torch.zeros(FLAGS.batch_size,
-                                           dtype=torch.int64)),
+        data=fake_data,
         sample_count=10000 // FLAGS.batch_size // xm.xrt_world_size())
   else:
-    train_dataset = datasets.MNIST(
-        os.path.join(FLAGS.datadir, str(xm.get_ordinal())),
-        train=True,
-        download=True,
-        transform=transforms.Compose(
-            [transforms.ToTensor(),
-             transforms.Normalize((0.1307,), (0.3081,))]))
-    test_dataset = datasets.MNIST(
-        os.path.join(FLAGS.datadir, str(xm.get_ordinal())),
-        train=False,
-        download=True,
-        transform=transforms.Compose(
-            [transforms.ToTensor(),
-             transforms.Normalize((0.1307,), (0.3081,))]))
+    train_dataset = _get_mnist_dataset(train=True)
+    test_dataset = _get_mnist_dataset(
+        train=False, batch_multiple=FLAGS.batch_size)
     train_sampler = None
     if xm.xrt_world_size() > 1:
       train_sampler = torch.utils.data.distributed.DistributedSampler(
@@ -95,30 +112,33 @@ def train_mnist():
           num_replicas=xm.xrt_world_size(),
           rank=xm.get_ordinal(),
           shuffle=True)
+    # To keep batch shapes static, the train loader always drops the last
+    # partial batch and the test split is padded, so --drop_last is ignored.
+    if FLAGS.drop_last:
+      xm.master_print('--drop_last has no effect, the script always uses '
+                      'fixed-size batches')
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=FLAGS.batch_size,
         sampler=train_sampler,
-        drop_last=FLAGS.drop_last,
+        drop_last=True,
         shuffle=False if train_sampler else True,
         num_workers=FLAGS.num_workers)
     test_loader = torch.utils.data.DataLoader(
         test_dataset,
         batch_size=FLAGS.batch_size,
-        drop_last=FLAGS.drop_last,
         shuffle=False,
         num_workers=FLAGS.num_workers)
 
   # Scale learning rate to num cores
   lr = FLAGS.lr * xm.xrt_world_size()
 
-  device = xm.xla_device()
   model = MNIST().to(device)
   writer = None
   if xm.is_master_ordinal():
     writer = test_utils.get_summary_writer(FLAGS.logdir)
   optimizer = optim.SGD(model.parameters(), lr=lr, momentum=FLAGS.momentum)
-  loss_fn = nn.NLLLoss()
+  loss_fn = nn.CrossEntropyLoss()
 
   def train_loop_fn(loader):
     tracker = xm.RateTracker()
@@ -130,28 +150,31 @@ def train_mnist():
       loss = loss_fn(output, target)
       loss.backward()
       xm.optimizer_step(optimizer)
-      tracker.add(FLAGS.batch_size)
       if step % FLAGS.log_steps == 0:
+        # Account for all the steps run since the previous report.
+        tracker.add(FLAGS.batch_size * (FLAGS.log_steps if step else 1))
         xm.add_step_closure(
             _train_update, args=(device, step, loss, tracker, writer))
 
   def test_loop_fn(loader):
-    total_samples = 0
-    correct = 0
+    total_samples = torch.zeros((), dtype=torch.int64, device=device)
+    correct = torch.zeros((), dtype=torch.int64, device=device)
     model.eval()
     for data, target in loader:
       output = model(data)
-      pred = output.max(1, keepdim=True)[1]
-      correct += pred.eq(target.view_as(pred)).sum()
-      total_samples += data.size()[0]
+      correct += (output.argmax(1) == target).sum()
+      total_samples += (target >= 0).sum()
 
-    accuracy = 100.0 * correct.item() / total_samples
-    accuracy = xm.mesh_reduce('test_accuracy', accuracy, np.mean)
-    return accuracy
+    if xm.xrt_world_size() > 1:
+      xm.all_reduce(xm.REDUCE_SUM, [correct, total_samples])
+      # Materialize both reduced values with a single device execution.
+      xm.mark_step()
+    return 100.0 * correct.item() / total_samples.item()
 
   train_device_loader = pl.MpDeviceLoader(train_loader, device)
   test_device_loader = pl.MpDeviceLoader(test_loader, device)
   accuracy, max_accuracy = 0.0, 0.0
+  compile_count = 0
   for epoch in range(1, FLAGS.num_epochs + 1):
     xm.master_print('Epoch {} train begin {}'.format(epoch, test_utils.now()))
     train_loop_fn(train_device_loader)
@@ -168,6 +191,17 @@ def train_mnist():
         write_xla_metrics=True)
     if FLAGS.metrics_debug:
       xm.master_print(met.metrics_report())
+    # All the train and test graphs are compiled within the first two epochs,
+    # as input shapes are static. Anything after that is a recompilation.
+    last_compile_count, compile_count = compile_count, _get_compile_count()
+    if epoch > 2 and compile_count > last_compile_count:
+      raise RuntimeError(
+          'Epoch {} triggered {} new XLA compilations, expected none'.format(
+              epoch, compile_count - last_compile_count))
+    # Fake data runs are throughput benchmarks, and trivially reach the target
+    # accuracy, so they always run for FLAGS.num_epochs.
+    if not FLAGS.fake_data and accuracy >= FLAGS.target_accuracy:
+      break
 
   test_utils.close_summary_writer(writer)
   xm.master_print('Max Accuracy: {:.2f}%'.format(max_accuracy))
@@ -188,4 +222,8 @@ def _mp_fn(index, flags):
 
 
 if __name__ == '__main__':
+  if FLAGS.use_bf16:
+    # Must be set before the XLA devices are created, so that the worker
+    # processes inherit it and store float tensors as bfloat16 on TPU.
+    os.environ['XLA_USE_BF16'] = '1'
   xmp.spawn(_mp_fn, args=(FLAGS,), nprocs=FLAGS.num_cores)